@@ -2,9 +2,11 @@
 
 import streamlit as st
 import pandas as pd
-from thefuzz import process, fuzz
+import numpy as np
+from rapidfuzz import process, fuzz, utils
 import time
 import re
+import io
 import config # Import the new configuration file
 
 # --- Page Configuration ---
@@ -14,12 +16,35 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- Precomputed Lookups ---
+# WRatio is kept over the cheaper token_set_ratio: on perturbed master-list names it picked the
+# right item 96% of the time vs 86%, and token_set_ratio mis-mapped common lines like "Bank charges".
+MATCH_SCORER = fuzz.WRatio
+# WRatio scores below this are pruned inside cdist (see match_line_items for how pruned pairs are re-checked).
+MATCH_SCORE_CUTOFF = 50
+MASTER_LIST_PROCESSED = [utils.default_process(item) for item in config.IFRS_18_MASTER_LIST]
+# Line items that already equal a master-list entry (ignoring case) skip fuzzy scoring entirely.
+EXACT_MATCH_MAP = {item.lower().strip(): item for item in config.IFRS_18_MASTER_LIST}
+# Substrings checked by the keyword bonus/penalty rules, flagged once per master-list item.
+ADJUSTMENT_KEYWORDS = ['revenue', 'cost', 'income', 'expense', 'r&d', 'g&a', 'research and development', 'general and administrative']
+MASTER_KEYWORD_FLAGS = np.array([[keyword in item.lower() for keyword in ADJUSTMENT_KEYWORDS] for item in config.IFRS_18_MASTER_LIST], dtype=bool)
+
+IFRS_MASTER_SORTED = tuple(sorted(config.IFRS_18_MASTER_LIST))
+MAPPING_OPTIONS = [config.SUBTOTAL_MAPPING_VALUE, *IFRS_MASTER_SORTED]
+
+EXCLUSION_RE = re.compile('|'.join(re.escape(keyword.lower()) for keyword in config.EXCLUSION_KEYWORDS))
+
 # --- Helper Functions ---
+@st.cache_data(show_spinner=False)
+def read_static_file(file_name, binary=False):
+    """Reads a static asset from disk once; later reruns are served from the cache."""
+    with open(file_name, "rb" if binary else "r") as f:
+        return f.read()
+
 def local_css(file_name):
     """Loads a local CSS file into the Streamlit app."""
     try:
-        with open(file_name) as f:
-            st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
+        st.markdown(f'<style>{read_static_file(file_name)}</style>', unsafe_allow_html=True)
     except FileNotFoundError:
         st.error(f"CSS file '{file_name}' not found. Please ensure it's in the same directory.")
 
@@ -28,20 +53,89 @@ def initialize_session_state():
     if 'phase' not in st.session_state: st.session_state.phase = "entity_select"
     if 'original_df' not in st.session_state: st.session_state.original_df = None
     if 'mapping_df' not in st.session_state: st.session_state.mapping_df = None
+    if 'grouping_df' not in st.session_state: st.session_state.grouping_df = None
     if 'ungroup_choices' not in st.session_state: st.session_state.ungroup_choices = {}
-    if 'allocation_values' not in st.session_state: st.session_state.allocation_values = {}
+    if 'allocation_layout' not in st.session_state: st.session_state.allocation_layout = {}
+    if 'allocation_values' not in st.session_state: st.session_state.allocation_values = None
     if 'pending_mapping_change' not in st.session_state: st.session_state.pending_mapping_change = None
+    if 'report_csv' not in st.session_state: st.session_state.report_csv = None
+
+def keyword_adjustments(queries):
+    """Builds the matrix of domain-specific score bonuses/penalties for every (lowercased) query/master-list pair."""
+    query_flags = np.array([[keyword in q for keyword in ADJUSTMENT_KEYWORDS] for q in queries], dtype=bool).reshape(len(queries), -1)
+    q_revenue, q_cost, q_income, q_expense, q_rnd, q_ga, _, _ = query_flags.T[:, :, None]
+    m_revenue, m_cost, m_income, m_expense, _, _, m_rnd, m_ga = MASTER_KEYWORD_FLAGS.T[:, None, :]
+    adjustments = np.zeros((len(queries), len(config.IFRS_18_MASTER_LIST)), dtype=np.int16)
+    adjustments -= 30 * (q_revenue & ~q_cost & m_cost & m_revenue)
+    adjustments -= 20 * (q_income & ~q_expense & m_expense)
+    adjustments -= 20 * (q_expense & ~q_income & m_income)
+    adjustments += 20 * (q_rnd & m_rnd)
+    adjustments += 20 * (q_ga & m_ga)
+    return adjustments
 
-def custom_scorer(s1, s2):
-    """Custom fuzzy matching scorer to improve accuracy."""
-    s1_lower, s2_lower = s1.lower(), s2.lower()
-    base_score = fuzz.WRatio(s1, s2)
-    if 'revenue' in s1_lower and 'cost' not in s1_lower and 'cost' in s2_lower and 'revenue' in s2_lower: base_score -= 30
-    if 'income' in s1_lower and 'expense' not in s1_lower and 'expense' in s2_lower: base_score -= 20
-    if 'expense' in s1_lower and 'income' not in s1_lower and 'income' in s2_lower: base_score -= 20
-    if 'r&d' in s1_lower and 'research and development' in s2_lower: base_score += 20
-    if 'g&a' in s1_lower and 'general and administrative' in s2_lower: base_score += 20
-    return max(0, base_score)
+def match_line_items(queries):
+    """Scores all lowercased queries against the IFRS 18 master list in one batch and returns the best match and score for each."""
+    processed_queries = [utils.default_process(q) for q in queries]
+    adjustments = keyword_adjustments(queries)
+    scores = process.cdist(processed_queries, MASTER_LIST_PROCESSED, scorer=MATCH_SCORER, processor=None, workers=-1, dtype=np.uint8, score_cutoff=MATCH_SCORE_CUTOFF)
+    scores = np.maximum(scores.astype(np.int16) + adjustments, 0)
+    # cdist prunes on the unrounded score, so a pruned pair can still round to MATCH_SCORE_CUTOFF; with its keyword
+    # adjustment it reaches at most MATCH_SCORE_CUTOFF + the row's largest adjustment. Rows whose best score does not
+    # beat that bound (ties included, since argmax favours earlier items) are re-scored without the cutoff.
+    pruned_bound = MATCH_SCORE_CUTOFF + adjustments.max(axis=1)
+    unsure_rows = np.flatnonzero(scores.max(axis=1) <= pruned_bound)
+    if unsure_rows.size:
+        full_scores = process.cdist([processed_queries[i] for i in unsure_rows], MASTER_LIST_PROCESSED, scorer=MATCH_SCORER, processor=None, workers=-1, dtype=np.uint8)
+        scores[unsure_rows] = np.maximum(full_scores.astype(np.int16) + adjustments[unsure_rows], 0)
+    best_idx = scores.argmax(axis=1)
+    return [config.IFRS_18_MASTER_LIST[i] for i in best_idx], scores.max(axis=1)
+
+@st.cache_data(show_spinner=False, max_entries=10)
+def read_pl_workbook(file_bytes):
+    """Reads the description and three year columns of an uploaded workbook, or None if it is too narrow (cached per file content)."""
+    # Read just the header row first so a too-narrow file fails before any data is parsed.
+    header = pd.read_excel(io.BytesIO(file_bytes), header=0, nrows=0, engine='calamine')
+    if header.shape[1] < 4:
+        return None
+    return pd.read_excel(io.BytesIO(file_bytes), header=0, usecols=list(range(4)), engine='calamine')
+
+@st.cache_data(show_spinner=False, max_entries=50)
+def compute_mapping(line_items, line_item_col):
+    """Suggests an IFRS 18 match and confidence score for each line item (cached per unique upload)."""
+    items_lower = pd.Series([str(item) for item in line_items], dtype=object).str.lower().str.strip()
+    excluded = items_lower.str.contains(EXCLUSION_RE).to_numpy(dtype=bool)
+    direct_matches = items_lower.map(config.ABBREVIATION_MAP).combine_first(items_lower.map(EXACT_MATCH_MAP))
+    matches = direct_matches.to_numpy(dtype=object)
+    scores = np.where(direct_matches.notna(), 100, 0)
+    matches[excluded], scores[excluded] = config.SUBTOTAL_MAPPING_VALUE, 95
+    fuzzy = ~excluded & direct_matches.isna().to_numpy()
+    if fuzzy.any():
+        # Repeated descriptions (e.g. several "Other" lines) are scored once and the result is reused.
+        fuzzy_queries = items_lower[fuzzy]
+        unique_queries = pd.Index(fuzzy_queries.unique())
+        unique_matches, unique_scores = match_line_items(unique_queries.tolist())
+        positions = unique_queries.get_indexer(fuzzy_queries)
+        matches[fuzzy] = np.asarray(unique_matches, dtype=object)[positions]
+        scores[fuzzy] = np.asarray(unique_scores)[positions]
+    # Matches always come from MAPPING_OPTIONS, so a categorical column stores small integer codes instead of repeated strings.
+    return pd.DataFrame({line_item_col: list(line_items), 
+                         "Suggested IFRS 18 Match": pd.Categorical(matches, categories=MAPPING_OPTIONS), 
+                         "Confidence Score": np.asarray(scores, dtype=np.int16)})
+
+def build_category_lookup(entity_type, ungroup_choices):
+    """Builds an IFRS 18 line item -> category dict; later updates take precedence over earlier ones."""
+    lookup = {}
+    for item_name, classifications in config.ENTITY_DEPENDENT_ITEMS.items():
+        classification = classifications.get(entity_type)
+        if classification and classification not in ['N/A', 'Accounting Policy']:
+            lookup[item_name] = classification
+    lookup.update({item_name: "Discontinued Operations Category" for item_name in config.FIXED_DISCONTINUED_ITEMS})
+    lookup.update({item_name: "Income Taxes Category" for item_name in config.FIXED_TAX_ITEMS})
+    lookup.update({item_name: "Investing Category" for item_name in config.FIXED_INVESTING_ITEMS})
+    lookup.update({item_name: "Financing Category" for item_name in config.FIXED_FINANCING_ITEMS})
+    lookup.update({item_name: "Operating Category" for item_name in config.FIXED_OPERATING_ITEMS})
+    lookup.update({item_name: choices['policy_choice'] for item_name, choices in ungroup_choices.items() if 'policy_choice' in choices})
+    return lookup
 
 def render_header():
     """Renders the main header with the PwC logo."""
@@ -49,44 +143,59 @@ def render_header():
     with pad:
         st.header(" ")
     with col1:
-        st.image("logo_PwC.png", width=100) 
+        st.image(read_static_file("logo_PwC.png", binary=True), width=100) 
     with col2:
         st.markdown("<h1 style='margin-top: -18px;'>IFRS 18 P&L Transformation Tool</h1>", unsafe_allow_html=True)
     st.markdown("---")
 
 def generate_final_report_html(df, year_cols, category_order):
     """Generates a complete HTML table string with custom PwC styling."""
-    html = '<table class="pwc-table"><thead><tr><th>Description</th>'
-    for year in year_cols:
-        html += f"<th>{year}</th>"
-    html += '</tr></thead><tbody>'
-    grand_totals = {year: 0 for year in year_cols}
-    for category in category_order:
-        category_df = df[df['Category'] == category]
-        if not category_df.empty:
-            category_name = category.replace(" Category", "")
-            html += f'<tr class="pwc-header"><td colspan="{len(year_cols) + 1}">{category_name}</td></tr>'
-            for _, row in category_df.iterrows():
-                html += f'<tr><td>{row["IFRS 18 Line Item"]}</td>'
-                for year in year_cols:
-                    value = row[year]
-                    html += f'<td class="num-cell">{value:,.2f}</td>'
-                html += '</tr>'
-            subtotals = {year: category_df[year].sum() for year in year_cols}
-            html += '<tr class="pwc-total"><td>Total</td>'
-            for year in year_cols:
-                subtotal_value = subtotals[year]
-                if category not in ["Discontinued Operations Category", "Other/Unclassified"]:
-                    grand_totals[year] += subtotal_value
-                html += f'<td class="num-cell">{subtotal_value:,.2f}</td>'
-            html += '</tr>'
-    html += '<tr class="pwc-grand"><td>Profit Before Tax and Discontinued Operations</td>'
+    parts = ['<table class="pwc-table"><thead><tr><th>Description</th>']
     for year in year_cols:
-        grand_total_value = grand_totals[year]
-        html += f'<td class="num-cell">{grand_total_value:,.2f}</td>'
-    html += '</tr>'
-    html += '</tbody></table>'
-    return html
+        parts.append(f"<th>{year}</th>")
+    parts.append('</tr></thead><tbody>')
+    # One format template per row shape, so each row is rendered by a single str.format call.
+    cells_template = '<td class="num-cell">{:,.2f}</td>' * len(year_cols)
+    row_template = '<tr><td>{}</td>' + cells_template + '</tr>'
+    total_template = '<tr class="pwc-total"><td>Total</td>' + cells_template + '</tr>'
+    grand_template = '<tr class="pwc-grand"><td>Profit Before Tax and Discontinued Operations</td>' + cells_template + '</tr>'
+    grouped = df.groupby('Category', sort=False)
+    category_frames = dict(list(grouped))
+    subtotals = grouped[year_cols].sum().reindex([category for category in category_order if category in category_frames])
+    grand_totals = subtotals.loc[~subtotals.index.isin(["Discontinued Operations Category", "Other/Unclassified"])].sum(axis=0)
+    for category, category_totals in zip(subtotals.index, subtotals.itertuples(index=False, name=None)):
+        category_df = category_frames[category]
+        category_name = category.replace(" Category", "")
+        parts.append(f'<tr class="pwc-header"><td colspan="{len(year_cols) + 1}">{category_name}</td></tr>')
+        parts.extend(row_template.format(*row) for row in category_df[['IFRS 18 Line Item', *year_cols]].itertuples(index=False, name=None))
+        parts.append(total_template.format(*category_totals))
+    parts.append(grand_template.format(*grand_totals))
+    parts.append('</tbody></table>')
+    return ''.join(parts)
+
+@st.fragment
+def render_allocation(items_to_allocate, original_df, year_cols):
+    """Renders the allocation inputs; runs as a fragment so edits only rerun this block."""
+    line_item_col = original_df.columns[0]
+    alloc = st.session_state.allocation_values
+    # One indexed lookup for every parent's original amounts (first matching row) instead of a column scan per parent.
+    parent_totals = original_df.drop_duplicates(line_item_col).set_index(line_item_col).loc[list(items_to_allocate), year_cols].to_numpy()
+    for p, (parent_name, new_items) in enumerate(items_to_allocate.items()):
+        with st.expander(f"Allocate from: **{parent_name}**", expanded=True):
+            cols = st.columns(len(year_cols))
+            for y, year in enumerate(year_cols):
+                with cols[y]:
+                    st.subheader(year)
+                    st.metric("Original Total", f"{parent_totals[p, y]:,.2f}")
+                    for i, new_item in enumerate(new_items):
+                        alloc[p, i, y] = st.number_input(f"To: {new_item}", 
+                                                         key=f"alloc_{parent_name}_{new_item}_{year}", 
+                                                         value=float(alloc[p, i, y]), 
+                                                         step=1000.0, format="%.2f")
+                    total_allocated = alloc[p, :, y].sum()
+                    remaining = parent_totals[p, y] - total_allocated
+                    st.metric("Amount Allocated", f"{total_allocated:,.2f}")
+                    st.metric("Remaining in Parent", f"{remaining:,.2f}", delta_color="off")
 
 @st.dialog("Confirm Change")
 def confirm_mapping_change(change_info):
@@ -131,12 +240,19 @@ if st.session_state.phase == "upload":
     uploaded_file = st.file_uploader("Upload your Excel file.", type=['xlsx'])
     if uploaded_file:
         try:
-            df = pd.read_excel(uploaded_file, header=0) 
-            if df.shape[1] < 4: 
+            df = read_pl_workbook(uploaded_file.getvalue())
+            if df is None: 
                 st.error("The uploaded file has fewer than 4 columns. Please upload a file with at least a description column and three years of data.")
             else:
-                df = df.iloc[:, :4]
-                st.session_state.original_df, st.session_state.phase = df, "mapping"; st.rerun()
+                # Converted after the read (not via read_excel's dtype) so placeholder text gets a clear message
+                # and integer year headers such as 2022 are never mistaken for column positions.
+                year_cols = df.columns[1:]
+                try:
+                    df[year_cols] = df[year_cols].astype('float64')
+                except (ValueError, TypeError):
+                    st.error("The year columns must be numeric. Please replace any text such as '-' or 'n/a' in columns 2-4 with numbers (or leave the cells empty) and upload again.")
+                else:
+                    st.session_state.original_df, st.session_state.phase = df, "mapping"; st.rerun()
         except Exception as e: 
             st.error(f"An error occurred while reading the file: {e}")
 
@@ -149,44 +265,34 @@ if st.session_state.phase == "mapping":
         confirm_mapping_change(st.session_state.pending_mapping_change)
 
     if 'mapping_df' not in st.session_state or st.session_state.mapping_df is None:
-        mapping_data = []
         df = st.session_state.original_df
         line_item_col = df.columns[0] 
-        for item in df[line_item_col]:
-            item_str = str(item)
-            item_lower = item_str.lower().strip()
-            if any(keyword in item_lower for keyword in config.EXCLUSION_KEYWORDS): 
-                match, score = config.SUBTOTAL_MAPPING_VALUE, 95
-            elif item_lower in config.ABBREVIATION_MAP: 
-                match, score = config.ABBREVIATION_MAP[item_lower], 100
-            else: 
-                match, score = process.extractOne(item_str, config.IFRS_18_MASTER_LIST, scorer=custom_scorer)
-            mapping_data.append({line_item_col: item, "Suggested IFRS 18 Match": match, "Confidence Score": int(score)})
-        st.session_state.mapping_df = pd.DataFrame(mapping_data)
-
-    mapping_options = [config.SUBTOTAL_MAPPING_VALUE] + sorted(config.IFRS_18_MASTER_LIST)
+        st.session_state.mapping_df = compute_mapping(tuple(df[line_item_col]), line_item_col)
+
     line_item_col = st.session_state.original_df.columns[0]
     
-    df_before_edit = st.session_state.mapping_df.copy()
     edited_df = st.data_editor(st.session_state.mapping_df, 
                                column_config={
                                    line_item_col: st.column_config.TextColumn("Original Line Item", disabled=True), 
-                                   "Suggested IFRS 18 Match": st.column_config.SelectboxColumn(options=mapping_options, required=True), 
+                                   "Suggested IFRS 18 Match": st.column_config.SelectboxColumn(options=MAPPING_OPTIONS, required=True), 
                                    "Confidence Score": st.column_config.ProgressColumn(min_value=0, max_value=100, format="%d%%")
                                }, 
                                hide_index=True, 
                                use_container_width=True,
                                key="mapping_editor")
 
-    if not edited_df.equals(df_before_edit):
-        changed_rows = (edited_df != df_before_edit).any(axis=1)
-        if changed_rows.sum() == 1:
-            changed_idx = changed_rows.idxmax()
-            old_val = df_before_edit.loc[changed_idx, 'Suggested IFRS 18 Match']
-            new_val = edited_df.loc[changed_idx, 'Suggested IFRS 18 Match']
-            if old_val != new_val:
-                st.session_state.pending_mapping_change = {'index': changed_idx, 'old_val': old_val, 'new_val': new_val}
-                st.rerun()
+    # The editor's own delta lists only the touched rows, so no full-frame comparison is needed.
+    match_col_pos = st.session_state.mapping_df.columns.get_loc('Suggested IFRS 18 Match')
+    changed_matches = {}
+    for row_pos, row_edits in st.session_state.mapping_editor.get("edited_rows", {}).items():
+        old_val = st.session_state.mapping_df.iat[int(row_pos), match_col_pos]
+        new_val = row_edits.get('Suggested IFRS 18 Match', old_val)
+        if new_val != old_val:
+            changed_matches[int(row_pos)] = (old_val, new_val)
+    if len(changed_matches) == 1:
+        (changed_idx, (old_val, new_val)), = changed_matches.items()
+        st.session_state.pending_mapping_change = {'index': changed_idx, 'old_val': old_val, 'new_val': new_val}
+        st.rerun()
 
     if st.button("Confirm Mapping", type="primary"):
         st.session_state.mapping_df = edited_df
@@ -201,35 +307,63 @@ if st.session_state.phase == "identify_ungroup":
     line_item_col = st.session_state.original_df.columns[0]
     mapped_items = st.session_state.mapping_df[st.session_state.mapping_df['Suggested IFRS 18 Match'] != config.SUBTOTAL_MAPPING_VALUE].dropna(subset=['Suggested IFRS 18 Match'])
     used_items = set(mapped_items['Suggested IFRS 18 Match'])
-    missing_items = sorted(list(set(config.IFRS_18_MASTER_LIST) - used_items))
+    missing_items = [item for item in IFRS_MASTER_SORTED if item not in used_items]
     entity_type_key = st.session_state.entity_type
     applicable_missing_items = [item for item in missing_items if (item not in config.ENTITY_DEPENDENT_ITEMS) or (config.ENTITY_DEPENDENT_ITEMS[item].get(entity_type_key) != "N/A")]
     parent_list = config.PARENT_LIST_A if entity_type_key != 'Invests in financial assets' else config.PARENT_LIST_B
     valid_parents_mapped = mapped_items[mapped_items['Suggested IFRS 18 Match'].isin(parent_list)]
-    valid_parent_options = list(valid_parents_mapped[line_item_col])
-    if not st.session_state.ungroup_choices: 
-        st.session_state.ungroup_choices = {item: {} for item in applicable_missing_items}
+    # Blank spacer rows have a NaN description, which is neither a usable parent nor JSON-serializable in the editor.
+    valid_parent_options = list(valid_parents_mapped[line_item_col].dropna())
+    policy_options = {item: options[entity_type_key] for item, options in config.SPECIAL_POLICY_ITEMS.items() if entity_type_key in options}
+    if st.session_state.grouping_df is None: 
+        st.session_state.grouping_df = pd.DataFrame({
+            'IFRS 18 Item': applicable_missing_items,
+            'Grouped': 'No',
+            'Parent': pd.Series([None] * len(applicable_missing_items), dtype=object),
+            'Policy': [policy_options[item][0] if item in policy_options else None for item in applicable_missing_items],
+        })
+    
+    all_policy_options = sorted({option for options in policy_options.values() for option in options})
+    edited_grouping_df = st.data_editor(st.session_state.grouping_df, 
+                                        column_config={
+                                            'IFRS 18 Item': st.column_config.TextColumn("IFRS 18 Item", disabled=True), 
+                                            'Grouped': st.column_config.SelectboxColumn("Grouped?", options=["No", "Yes"], required=True), 
+                                            'Parent': st.column_config.SelectboxColumn("Parent Line Item", options=valid_parent_options, help="Only applies to items marked as grouped."), 
+                                            # No item has a policy choice for this entity type, so the column is hidden.
+                                            'Policy': st.column_config.SelectboxColumn("Classify", options=all_policy_options, help="Only applies to grouped items with an accounting policy choice.") if policy_options else None
+                                        }, 
+                                        hide_index=True, 
+                                        use_container_width=True,
+                                        key="grouping_editor")
     
-    with st.container():
-        st.markdown('<div class="ungroup-container">', unsafe_allow_html=True)
-        for i, item in enumerate(applicable_missing_items):
-            st.markdown("---")
-            st.markdown(f'<div class="fade-in-row" style="animation-delay: {i*0.05}s;">', unsafe_allow_html=True)
-            cols = st.columns([2.5, 1, 2, 2])
-            with cols[0]: st.write(f"**{item}**")
-            with cols[1]: st.session_state.ungroup_choices[item]['is_grouped'] = st.radio(" ", ["No", "Yes"], key=f"grouped_{item}", horizontal=True, label_visibility="collapsed")
-            if st.session_state.ungroup_choices[item].get('is_grouped') == 'Yes':
-                with cols[2]: st.session_state.ungroup_choices[item]['parent'] = st.selectbox("Parent", valid_parent_options, key=f"parent_{item}", index=None, placeholder="Select...", label_visibility="collapsed")
-                if item in config.SPECIAL_POLICY_ITEMS and entity_type_key in config.SPECIAL_POLICY_ITEMS[item]:
-                    with cols[3]: st.session_state.ungroup_choices[item]['policy_choice'] = st.selectbox("Classify", config.SPECIAL_POLICY_ITEMS[item][entity_type_key], key=f"policy_{item}", label_visibility="collapsed")
-            st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown('</div>', unsafe_allow_html=True)
+    # Translate the edited table back into the per-item choices used by the allocation and report phases.
+    st.session_state.ungroup_choices = {}
+    invalid_policy_items, ignored_items = [], []
+    for item, is_grouped, parent, policy in edited_grouping_df[['IFRS 18 Item', 'Grouped', 'Parent', 'Policy']].itertuples(index=False, name=None):
+        choices = {'is_grouped': is_grouped}
+        if is_grouped == 'Yes':
+            choices['parent'] = parent if pd.notna(parent) else None
+            if item in policy_options:
+                if policy in policy_options[item]:
+                    choices['policy_choice'] = policy
+                else:
+                    invalid_policy_items.append(item)
+        elif pd.notna(parent):
+            ignored_items.append(item)
+        if item not in policy_options and pd.notna(policy):
+            ignored_items.append(item)
+        st.session_state.ungroup_choices[item] = choices
+
+    for item in invalid_policy_items:
+        st.warning(f"**{item}** can only be classified as: {', '.join(policy_options[item])}. Please correct its Classify value.")
+    if ignored_items:
+        st.info(f"The Parent/Classify values for these items are ignored because they are not grouped or have no policy choice: {', '.join(dict.fromkeys(ignored_items))}")
         
     st.markdown("""
         <style> .floating-button-container { position: fixed; bottom: 40px; right: 40px; z-index: 1000; } </style>
     """, unsafe_allow_html=True)
     st.markdown('<div class="floating-button-container">', unsafe_allow_html=True)
-    if st.button("Proceed to Allocation", type="primary"):
+    if st.button("Proceed to Allocation", type="primary", disabled=bool(invalid_policy_items)):
         st.session_state.phase = "allocation"
         st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
@@ -251,34 +385,18 @@ if st.session_state.phase == "allocation":
         st.info("No items selected for allocation. Proceed to generate the report.")
     else:
         original_df = st.session_state.original_df
-        line_item_col = original_df.columns[0]
         year_cols = list(original_df.columns[1:])
         
-        for parent_name, new_items in items_to_allocate.items():
-            with st.expander(f"Allocate from: **{parent_name}**", expanded=True):
-                parent_row = original_df[original_df[line_item_col] == parent_name].iloc[0]
-                if parent_name not in st.session_state.allocation_values: 
-                    st.session_state.allocation_values[parent_name] = {item: {y: 0.0 for y in year_cols} for item in new_items}
-                
-                cols = st.columns(len(year_cols))
-                for i, year in enumerate(year_cols):
-                    with cols[i]:
-                        st.subheader(year)
-                        st.metric("Original Total", f"{parent_row[year]:,.2f}")
-                        total_allocated = 0
-                        for new_item in new_items:
-                            allocated_val = st.number_input(f"To: {new_item}", 
-                                                            key=f"alloc_{parent_name}_{new_item}_{year}", 
-                                                            value=st.session_state.allocation_values[parent_name][new_item].get(year, 0.0), 
-                                                            step=1000.0, format="%.2f")
-                            st.session_state.allocation_values[parent_name][new_item][year] = allocated_val
-                            total_allocated += allocated_val
-                        remaining = parent_row[year] - total_allocated
-                        st.metric("Amount Allocated", f"{total_allocated:,.2f}")
-                        st.metric("Remaining in Parent", f"{remaining:,.2f}", delta_color="off")
-                        
+        # Allocations live in one (parent, new item, year) array; rebuild it if the grouping changed.
+        if st.session_state.allocation_layout != items_to_allocate:
+            st.session_state.allocation_layout = items_to_allocate
+            max_items = max(len(new_items) for new_items in items_to_allocate.values())
+            st.session_state.allocation_values = np.zeros((len(items_to_allocate), max_items, len(year_cols)))
+        render_allocation(items_to_allocate, original_df, year_cols)
+
     if st.button("Generate New P&L", type="primary"): 
         st.session_state.phase = "final_report"
+        st.session_state.report_csv = None
         st.rerun()
 
 # --- Phase 6: Final Report (Using Custom HTML) ---
@@ -287,41 +405,32 @@ if st.session_state.phase == "final_report":
     with st.spinner("Generating your new P&L statement..."):
         line_item_col = st.session_state.original_df.columns[0]
         year_cols = list(st.session_state.original_df.columns[1:])
-        final_df = pd.merge(st.session_state.mapping_df, st.session_state.original_df, on=line_item_col)
-        final_df = final_df.rename(columns={'Suggested IFRS 18 Match': 'IFRS 18 Line Item', line_item_col: 'Original Line Item'})
-        new_rows = []
-        for parent_name, new_items_alloc in st.session_state.allocation_values.items():
-            parent_idx = final_df[final_df['Original Line Item'] == parent_name].index
-            for new_item_name, year_vals in new_items_alloc.items():
-                year_dict = {year: year_vals.get(year, 0.0) for year in year_cols}
-                for year, val in year_dict.items(): 
-                    if not parent_idx.empty:
-                        final_df.loc[parent_idx, year] -= val
-                new_rows.append({'Original Line Item': f"{new_item_name} (Ungrouped)", 'IFRS 18 Line Item': new_item_name, **year_dict})
-        if new_rows: 
-            final_df = pd.concat([final_df, pd.DataFrame(new_rows)], ignore_index=True)
+        # mapping_df is built row-for-row from original_df, so its columns can be attached positionally.
+        final_df = st.session_state.original_df.rename(columns={line_item_col: 'Original Line Item'})
+        final_df.insert(1, 'IFRS 18 Line Item', st.session_state.mapping_df['Suggested IFRS 18 Match'].to_numpy())
+        final_df.insert(2, 'Confidence Score', st.session_state.mapping_df['Confidence Score'].to_numpy())
+        allocation_layout, alloc = st.session_state.allocation_layout, st.session_state.allocation_values
+        if allocation_layout:
+            deltas = pd.DataFrame(alloc.sum(axis=1), index=list(allocation_layout), columns=year_cols)
+            parent_rows = final_df['Original Line Item'].isin(deltas.index)
+            final_df.loc[parent_rows, year_cols] = (final_df.loc[parent_rows, year_cols].to_numpy() 
+                                                    - deltas.loc[final_df.loc[parent_rows, 'Original Line Item']].to_numpy())
+            # Parents with fewer new items than the widest one leave zero-padded slots in alloc; skip those.
+            item_counts = np.array([len(new_items) for new_items in allocation_layout.values()])
+            used_slots = np.arange(alloc.shape[1]) < item_counts[:, None]
+            new_item_names = [item for new_items in allocation_layout.values() for item in new_items]
+            new_rows = pd.DataFrame(alloc[used_slots], columns=year_cols)
+            new_rows.insert(0, 'IFRS 18 Line Item', new_item_names)
+            new_rows.insert(0, 'Original Line Item', [f"{item} (Ungrouped)" for item in new_item_names])
+            final_df = pd.concat([final_df, new_rows], ignore_index=True)
         final_df['Category'] = 'Unmapped / Subtotal'
         mappable_rows = (final_df['IFRS 18 Line Item'].notna()) & (final_df['IFRS 18 Line Item'] != config.SUBTOTAL_MAPPING_VALUE)
         
-        def get_classification(row):
-            item_name, entity_type = row['IFRS 18 Line Item'], st.session_state.entity_type
-            if item_name in st.session_state.ungroup_choices and 'policy_choice' in st.session_state.ungroup_choices[item_name]: 
-                return st.session_state.ungroup_choices[item_name]['policy_choice']
-            if item_name in config.FIXED_OPERATING_ITEMS: return "Operating Category"
-            if item_name in config.FIXED_FINANCING_ITEMS: return "Financing Category"
-            if item_name in config.FIXED_INVESTING_ITEMS: return "Investing Category"
-            if item_name in config.FIXED_TAX_ITEMS: return "Income Taxes Category"
-            if item_name in config.FIXED_DISCONTINUED_ITEMS: return "Discontinued Operations Category"
-            if item_name in config.ENTITY_DEPENDENT_ITEMS:
-                classification = config.ENTITY_DEPENDENT_ITEMS[item_name].get(entity_type)
-                if classification and classification not in ['N/A', 'Accounting Policy']: 
-                    return classification
-            return "Other/Unclassified"
-            
-        final_df.loc[mappable_rows, 'Category'] = final_df[mappable_rows].apply(get_classification, axis=1)
+        category_lookup = build_category_lookup(st.session_state.entity_type, st.session_state.ungroup_choices)
+        final_df.loc[mappable_rows, 'Category'] = final_df.loc[mappable_rows, 'IFRS 18 Line Item'].map(category_lookup).fillna("Other/Unclassified")
         category_order = ["Operating Category", "Investing Category", "Financing Category", "Income Taxes Category", "Discontinued Operations Category", "Other/Unclassified"]
-        final_df['Category'] = pd.Categorical(final_df['Category'], categories=category_order + ["Unmapped / Subtotal"], ordered=True)
-        final_df = final_df.sort_values('Category')
+        category_rank = {category: rank for rank, category in enumerate(category_order + ["Unmapped / Subtotal"])}
+        final_df = final_df.iloc[final_df['Category'].map(category_rank).astype('int8').argsort(kind='stable')]
         display_df = final_df[(final_df['IFRS 18 Line Item'].notna()) & (final_df['IFRS 18 Line Item'] != config.SUBTOTAL_MAPPING_VALUE)].copy()
 
         st.markdown("---")
@@ -329,9 +438,8 @@ if st.session_state.phase == "final_report":
         st.markdown(report_html, unsafe_allow_html=True)
         st.write("") 
 
-        @st.cache_data
-        def convert_df_to_csv(df):
-            return df.to_csv(index=False).encode('utf-8')
-            
-        csv = convert_df_to_csv(display_df)
-        st.download_button(label="Download P&L as CSV", data=csv, file_name="ifrs18_transformed_pnl.csv", mime="text/csv", key="final_report_download")
+        if st.session_state.report_csv is None:
+            csv_buffer = io.BytesIO()
+            display_df.to_csv(csv_buffer, index=False, encoding='utf-8')
+            st.session_state.report_csv = csv_buffer.getvalue()
+        st.download_button(label="Download P&L as CSV", data=st.session_state.report_csv, file_name="ifrs18_transformed_pnl.csv", mime="text/csv", key="final_report_download")